@@ -30,9 +30,14 @@ python common_words_extraction.py   \
 """
 
 import argparse
+import functools
+import multiprocessing
 import os
 import random
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
 from pathlib import Path
 
 import wonderwords
@@ -60,6 +65,7 @@ parser.add_argument("--random_seed", type=int, default=42)
 parser.add_argument("--context_template", type=str, default='', help='prompt template for context')
 parser.add_argument("--query_template", type=str, default='', help='prompt template for query')
 parser.add_argument("--remove_newline_tab", action='store_true', help='remove `\n` and `\t` in all strings.')
+parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help='number of sample generation processes')
 
 parser.add_argument("--freq_cw", type=int, default=30)
 parser.add_argument("--freq_ucw", type=int, default=3)
@@ -67,6 +73,13 @@ parser.add_argument("--num_cw", type=int, default=10)
 
 args = parser.parse_args()
 random.seed(args.random_seed)
+RNG = random.Random(args.random_seed)
+
+# With more than one worker, samples are generated in forked processes (see `sys_word_pair_random`). Unless the user
+# chose otherwise, keep the tokenizer from starting its thread pool so that the parent is single-threaded when it
+# forks; process-level parallelism then replaces the tokenizer's own.
+if args.num_workers > 1:
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
 
 # Load Tokenizer
 TOKENIZER = select_tokenizer(args.tokenizer_type, args.tokenizer_path)
@@ -74,89 +87,149 @@ TOKENIZER = select_tokenizer(args.tokenizer_type, args.tokenizer_path)
 nouns = wonderwords.random_word._get_words_from_text_file("nounlist.txt")
 adjs = wonderwords.random_word._get_words_from_text_file("adjectivelist.txt")
 verbs = wonderwords.random_word._get_words_from_text_file("verblist.txt")
-words = nouns + adjs + verbs
-words = sorted(list(set(words)))
-random.Random(args.random_seed).shuffle(words)
+# Deduplicate in order; sorting is unnecessary as the words are shuffled right after
+words = list(dict.fromkeys(nouns + adjs + verbs))
+RNG.shuffle(words)
 
+# Token counts of each word as it appears inside a formatted list, i.e. after an index prefix. Tokenizing a word on
+# its own would also count whatever the tokenizer prepends to the start of a text (e.g. "▁" for Llama-2 tokenizers).
+LIST_HEAD_NUM_TOKENS = TOKENIZER.num_tokens('1.')
+WORD_NUM_TOKENS = {
+    word: num_tokens - LIST_HEAD_NUM_TOKENS
+    for word, num_tokens in zip(words, TOKENIZER.num_tokens_batch(['1. ' + word for word in words]))
+}
 
-def get_example(num_words, common_repeats=30, uncommon_repeats=3, common_nums=10):
-    word_list_full = random.sample(words, num_words)
-    common, uncommon = word_list_full[:common_nums], word_list_full[common_nums:]
-    word_list = common * int(common_repeats) + uncommon * int(uncommon_repeats)
-    random.Random(args.random_seed).shuffle(word_list)
 
-    # Formatting the word list as "1. word1 2. word2 3. word3 ..."
-    context = ' '.join([f"{i + 1}. {word}" for i, word in enumerate(word_list)])
+@functools.lru_cache(maxsize=None)
+def index_num_tokens(num_digits):
+    """Token count of a `num_digits`-digit index prefix (with its leading separator) inside a formatted list."""
+    head = f'1. {words[0]}'
+    return TOKENIZER.num_tokens(f'{head} {10 ** (num_digits - 1)}.') - TOKENIZER.num_tokens(head)
 
-    return context, common
 
+def estimate_num_tokens(word_list):
+    """Estimate the token count of `word_list` formatted as "1. word1 2. word2 3. word3 ..." from cached counts."""
+    num_tokens = sum(WORD_NUM_TOKENS[word] for word in word_list)
+    # Index prefixes of the same number of digits are assumed to share a token count
+    for num_digits in range(1, len(str(len(word_list))) + 1):
+        num_indices = min(len(word_list), 10**num_digits - 1) - 10 ** (num_digits - 1) + 1
+        num_tokens += num_indices * index_num_tokens(num_digits)
+    return num_tokens
 
-def generate_input_output(num_words):
-    if args.max_seq_length < 4096:
-        context_example, answer_example = get_example(20, 3, 1, args.num_cw)
-        context, answer = get_example(num_words, 6, 1, args.num_cw)
-    else:
-        context_example, answer_example = get_example(40, 10, 3, args.num_cw)
-        context, answer = get_example(num_words, args.freq_cw, args.freq_ucw, args.num_cw)
 
-    context_template, input_query = args.context_template, args.query_template
+def split_context_template(context_template):
+    """Split `context_template` around its `{context}` field, or return None if it needs `str.format` to render."""
+    prefix, field, suffix = context_template.partition('{context}')
+    if not field or any(brace in prefix + suffix for brace in '{}'):
+        return None
+    return prefix, suffix
 
-    input_example = (
-        context_template.format(context=context_example)
-        + input_query
-        + ' '.join([f"{i + 1}. {word}" for i, word in enumerate(answer_example)])
-    )
 
-    input_context = context_template.format(context=context)
+CONTEXT_TEMPLATE_SPLIT = split_context_template(args.context_template)
 
-    return input_example + "\n" + input_context, input_query, answer
 
+def format_context(context):
+    """Fill the context template by plain concatenation, without parsing the format string on every call."""
+    if CONTEXT_TEMPLATE_SPLIT is None:
+        return args.context_template.format(context=context)
+    prefix, suffix = CONTEXT_TEMPLATE_SPLIT
+    return prefix + context + suffix
 
-def sys_word_pair_random(num_samples: int, max_seq_length: int, save_dir: str, incremental: int = 10):
-    write_jsons = []
-    tokens_to_generate = args.tokens_to_generate
 
-    # Find the perfect num_words
-    num_words = incremental
+# Token count of the static prompt pieces of an input: the context template of the example and the actual context,
+# the query after each of them and the newline in between. These are the same for every example, and are tokenized
+# together in their final layout so that prefixes added to the start of a text are only counted once.
+PROMPT_NUM_TOKENS = TOKENIZER.num_tokens(
+    format_context('') + args.query_template + "\n" + format_context('') + args.query_template
+)
 
-    total_tokens = 0
-    while total_tokens + tokens_to_generate < max_seq_length:
+# "1. ", "2. ", "3. ", ... index prefixes, extended on demand and shared by every formatted word list
+IDX_PREFIX = []
 
-        context, query, answer = generate_input_output(num_words)
-        # Calculate the number of tokens in the example
-        total_tokens = len(
-            TOKENIZER.text_to_tokens(
-                context + query + ' ' + ' '.join([f"{i + 1}. {word}" for i, word in enumerate(answer)])
-            )
-        )
-        print(f'Max length {max_seq_length} | Current length {total_tokens + tokens_to_generate} | Words: {num_words}')
-        if total_tokens + tokens_to_generate > max_seq_length:
-            num_words -= incremental
-            break
 
-        num_words += incremental
-        if num_words > len(words):
-            num_words = len(words)
-            break
+def format_word_list(word_list):
+    """Format `word_list` as "1. word1 2. word2 3. word3 ..."."""
+    IDX_PREFIX.extend(f"{i + 1}. " for i in range(len(IDX_PREFIX), len(word_list)))
+    return ' '.join(map(str.__add__, IDX_PREFIX, word_list))
 
-    print('num_words:', num_words)
 
-    # Generate samples
-    for index in tqdm(range(num_samples)):
-        used_words = num_words
-        while True:
-            try:
-                context, query, answer = generate_input_output(used_words)
-                length = len(TOKENIZER.text_to_tokens(context + query)) + tokens_to_generate
-                assert length <= max_seq_length, f"{length} exceeds max_seq_length."
-                break
-            except:
-                if used_words > incremental:
-                    used_words -= incremental
+def get_example(num_words, common_repeats=30, uncommon_repeats=3, common_nums=10, rng=RNG):
+    word_list_full = rng.sample(words, num_words)
+    common, uncommon = word_list_full[:common_nums], word_list_full[common_nums:]
+    # Extend in place so that the repeated uncommon words are not materialized in a temporary list first
+    word_list = common * int(common_repeats)
+    word_list.extend(chain.from_iterable(repeat(uncommon, int(uncommon_repeats))))
+    rng.shuffle(word_list)
+
+    # Formatting the word list as "1. word1 2. word2 3. word3 ..."
+    context = format_word_list(word_list)
+
+    return context, common, estimate_num_tokens(word_list)
+
+
+def generate_input_output(num_words, rng=RNG):
+    if args.max_seq_length < 4096:
+        context_example, answer_example, example_tokens = get_example(20, 3, 1, args.num_cw, rng=rng)
+        context, answer, context_tokens = get_example(num_words, 6, 1, args.num_cw, rng=rng)
+    else:
+        context_example, answer_example, example_tokens = get_example(40, 10, 3, args.num_cw, rng=rng)
+        context, answer, context_tokens = get_example(num_words, args.freq_cw, args.freq_ucw, args.num_cw, rng=rng)
+
+    input_query = args.query_template
+
+    input_example = format_context(context_example) + input_query + format_word_list(answer_example)
+
+    input_context = format_context(context)
+
+    # Estimated token count of the full input, including the query that follows the context
+    num_tokens = PROMPT_NUM_TOKENS + example_tokens + estimate_num_tokens(answer_example) + context_tokens
+
+    return input_example + "\n" + input_context, input_query, answer, num_tokens
+
+
+def make_samples(indices, num_words: int, max_seq_length: int, incremental: int = 10):
+    """Generate the samples at `indices`, tokenizing them as one batch and re-rolling only those that are too long."""
+    tokens_to_generate = args.tokens_to_generate
+
+    # Seeding each sample separately keeps the output independent of batching and worker scheduling
+    rngs = {index: random.Random(f'{args.random_seed}_{index}') for index in indices}
+    used_words = {index: num_words for index in indices}
+    # Difference between the tokenized and estimated length of each sample's last rejected attempt
+    estimate_offsets = {}
+    samples = {}
+    while len(samples) < len(indices):
+        pending = [index for index in indices if index not in samples]
+        examples = []
+        for index in pending:
+            example = generate_input_output(used_words[index], rng=rngs[index])
+            # After a rejection, back off on the corrected estimate instead of re-tokenizing every retry
+            while (
+                index in estimate_offsets
+                and used_words[index] > incremental
+                and example[3] + estimate_offsets[index] + tokens_to_generate > max_seq_length
+            ):
+                used_words[index] -= incremental
+                example = generate_input_output(used_words[index], rng=rngs[index])
+            examples.append(example)
+
+        batch_num_tokens = TOKENIZER.num_tokens_batch([context + query for context, query, _, _ in examples])
+        for index, example, num_tokens in zip(pending, examples, batch_num_tokens):
+            length = num_tokens + tokens_to_generate
+            if length <= max_seq_length:
+                samples[index] = (*example[:3], length)
+            else:
+                estimate_offsets[index] = num_tokens - example[3]
+                if used_words[index] > incremental:
+                    used_words[index] -= incremental
+
+    formatted_outputs = []
+    for index in indices:
+        context, query, answer, length = samples[index]
 
         if args.remove_newline_tab:
-            context = ' '.join(context.replace('\n', ' ').replace('\t', ' ').strip().split())
-            query = ' '.join(query.replace('\n', ' ').replace('\t', ' ').strip().split())
+            # split() already breaks on `\n` and `\t` and drops surrounding whitespace, in a single pass
+            context = ' '.join(context.split())
+            query = ' '.join(query.split())
 
         formatted_output = {
             'index': index,
@@ -165,20 +238,97 @@ def sys_word_pair_random(num_samples: int, max_seq_length: int, save_dir: str, i
             'outputs': answer,
             'length': length,
         }
-        write_jsons.append(formatted_output)
+        formatted_outputs.append(formatted_output)
+
+    return formatted_outputs
+
 
-    return write_jsons
+def sys_word_pair_random(
+    num_samples: int, max_seq_length: int, save_dir: str, incremental: int = 10, batch_size: int = 16
+):
+    tokens_to_generate = args.tokens_to_generate
+
+    # Calibration only needs one example per word count, so probes are shared by the search and the verification.
+    # Each probe also keeps the estimated token count of its formatted answer, which is never tokenized.
+    probes = {}
+
+    def probe(num_words):
+        if num_words not in probes:
+            context, query, answer, num_tokens = generate_input_output(num_words)
+            probes[num_words] = (context, query, num_tokens, estimate_num_tokens(answer))
+        return probes[num_words]
+
+    # Find the perfect num_words with a binary search over the estimated token count
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        _, _, num_tokens, answer_tokens = probe(mid)
+        total_tokens = num_tokens + answer_tokens
+        print(f'Max length {max_seq_length} | Estimated length {total_tokens + tokens_to_generate} | Words: {mid}')
+        if total_tokens + tokens_to_generate > max_seq_length:
+            hi = mid - 1
+        else:
+            lo = mid
+    num_words = lo
+
+    # Verify the estimate with the tokenizer, backing off until the example fits
+    while num_words > 0:
+        context, query, _, answer_tokens = probe(num_words)
+        # Calculate the number of tokens in the example
+        total_tokens = TOKENIZER.num_tokens(context + query) + answer_tokens
+        print(f'Max length {max_seq_length} | Current length {total_tokens + tokens_to_generate} | Words: {num_words}')
+        if total_tokens + tokens_to_generate <= max_seq_length:
+            break
+        num_words = max(num_words - incremental, 0)
+    probes.clear()
+
+    print('num_words:', num_words)
+
+    # Generate samples in parallel (or in this process with a single worker), `batch_size` samples per task. Workers
+    # are forked so that they inherit the tokenizer and word tables instead of reloading them. Only a bounded number
+    # of tasks is in flight at a time, so that finished batches do not pile up in memory ahead of the writer.
+    batches = [range(start, min(start + batch_size, num_samples)) for start in range(0, num_samples, batch_size)]
+    make_batch = functools.partial(
+        make_samples, num_words=num_words, max_seq_length=max_seq_length, incremental=incremental
+    )
+    max_in_flight = 2 * args.num_workers
+    progress = tqdm(total=num_samples)
+    if args.num_workers <= 1:
+        for indices in batches:
+            formatted_outputs = make_batch(indices)
+            yield from formatted_outputs
+            progress.update(len(formatted_outputs))
+        progress.close()
+        return
+
+    with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = deque()
+        for indices in batches:
+            futures.append(executor.submit(make_batch, indices))
+            if len(futures) >= max_in_flight:
+                formatted_outputs = futures.popleft().result()
+                yield from formatted_outputs
+                progress.update(len(formatted_outputs))
+        while futures:
+            formatted_outputs = futures.popleft().result()
+            yield from formatted_outputs
+            progress.update(len(formatted_outputs))
+    progress.close()
 
 
 def main():
     save_file = args.save_dir / f'{args.save_name}' / f'{args.subset}.jsonl'
     save_file.parent.mkdir(parents=True, exist_ok=True)
 
+    # Samples are generated lazily and streamed to disk as they are produced. They go to a temporary file that only
+    # replaces `save_file` once the last sample is written, so a failed run never leaves a truncated dataset behind.
     write_jsons = sys_word_pair_random(
         num_samples=args.num_samples, max_seq_length=args.max_seq_length, save_dir=args.save_dir
     )
 
-    write_jsonl(write_jsons, save_file)
+    tmp_file = save_file.with_suffix('.jsonl.tmp')
+    write_jsonl(write_jsons, tmp_file)
+    os.replace(tmp_file, save_file)
 
 
 if __name__ == "__main__":
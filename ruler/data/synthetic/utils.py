@@ -15,10 +15,12 @@
 
 import json
 
+import orjson
+
 
 def read_jsonl(filename, num_lines=-1):
     lines = []
-    with open(filename) as f:
+    with open(filename, encoding='utf-8') as f:
         for i, line in enumerate(f):
             lines.append(json.loads(line))
             if i == num_lines:
@@ -26,7 +28,7 @@ def read_jsonl(filename, num_lines=-1):
     return lines
 
 
-def write_jsonl(data, filename):
-    with open(filename, 'w') as f:
+def write_jsonl(data, filename, buffer_size=1 << 16):
+    with open(filename, 'wb', buffering=buffer_size) as f:
         for line in data:
-            f.write(json.dumps(line) + '\n')
+            f.write(orjson.dumps(line, option=orjson.OPT_APPEND_NEWLINE))
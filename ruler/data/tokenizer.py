@@ -37,6 +37,13 @@ class HFTokenizer:
         tokens = self.tokenizer.tokenize(text)
         return tokens
 
+    def num_tokens(self, text: str) -> int:
+        return self.num_tokens_batch([text])[0]
+
+    def num_tokens_batch(self, texts: List[str]) -> List[int]:
+        lengths = self.tokenizer(texts, add_special_tokens=False, return_length=True)['length']
+        return lengths
+
     def tokens_to_text(self, tokens: List[int]) -> str:
         text = self.tokenizer.convert_tokens_to_string(tokens)
         return text
@@ -15,6 +15,7 @@
 
 import argparse
 import os
+import subprocess
 from typing import List, Optional
 
 from babilong import PROMPT_TEMPLATES
@@ -74,14 +75,17 @@ def define_cmd_arguments():
     return parser.parse_args()
 
 
-def submit_job(cmd, log_dir, filename):
+def submit_job(cmd, log_dir, filename, log_filename=None):
     # Save the command to a file
     os.makedirs(log_dir, exist_ok=True)
     with open(os.path.join(log_dir, filename), 'w') as f:
         f.write(cmd)
 
-    # Submit the job
-    os.system(f'cd {BASE_DIR}; {cmd}')
+    # Submit the job without waiting for it, redirecting its output to `log_filename` if given
+    if log_filename is None:
+        return subprocess.Popen(cmd, shell=True, cwd=BASE_DIR)
+    with open(os.path.join(log_dir, log_filename), 'w') as log:
+        return subprocess.Popen(cmd, shell=True, cwd=BASE_DIR, stdout=log, stderr=subprocess.STDOUT)
 
 
 def main(
@@ -109,7 +113,8 @@ def main(
     # Inference Parameters
     stop_words = ','.join(PROMPT_TEMPLATES[prompt_config]['stop_words'])
 
-    # Schedule jobs for each sequence length
+    # Schedule data generation for each sequence length. Each length uses its own split, so these jobs run in parallel
+    schedules = []
     for seq_length in seq_lengths:
         seq_length_repr = f'{seq_length // 1024}k'
         if 'star' in attn_type and block_size + anchor_block_size > seq_length:
@@ -133,27 +138,43 @@ def main(
         os.makedirs(log_dir, exist_ok=True)
         os.makedirs(data_dir, exist_ok=True)
 
-        # Evaluate each task
+        # Prepare all tasks missing from the pre-generated data in a single job
+        task_data_files, missing_tasks = {}, []
         for task in tasks:
-            task_log_dir = os.path.join(log_dir, task)
-
-            # Prepare dataset
             task_data_file = (
                 os.path.join(pregen_data_dir, seq_length_repr, f'{task}_{seq_length_repr}.jsonl')
                 if pregen_data_dir
                 else None
             )
             if task_data_file is None or not os.path.exists(task_data_file):
-                data_gen_cmd = (
-                    f'python babilong/prepare_data.py '
-                    f'--download_dir {os.path.join(BASE_DIR, "dataset", "babilong")} '
-                    f'--output_dir {data_dir} '
-                    f'--tasks {task} '
-                    f'--split_names {seq_length_repr} '
-                    f'--model_template_type {prompt_config} '
-                )
-                submit_job(data_gen_cmd, task_log_dir, f'data_generation.sh')
+                missing_tasks.append(task)
                 task_data_file = os.path.join(data_dir, f'{task}_{seq_length_repr}.jsonl')
+            task_data_files[task] = task_data_file
+
+        data_gen_job = None
+        if missing_tasks:
+            data_gen_cmd = (
+                f'python babilong/prepare_data.py '
+                f'--download_dir {os.path.join(BASE_DIR, "dataset", "babilong")} '
+                f'--output_dir {data_dir} '
+                f'--tasks {" ".join(missing_tasks)} '
+                f'--split_names {seq_length_repr} '
+                f'--model_template_type {prompt_config} '
+            )
+            data_gen_job = submit_job(data_gen_cmd, log_dir, 'data_generation.sh', 'data_generation.log')
+
+        schedules.append((seq_length_repr, inference_executor, task_data_files, missing_tasks, data_gen_job))
+
+    # Evaluate each task once the data for its sequence length is ready
+    for seq_length_repr, inference_executor, task_data_files, missing_tasks, data_gen_job in schedules:
+        results_dir = os.path.join(output_dir, seq_length_repr)
+        log_dir = os.path.join(results_dir, 'logs')
+        data_gen_failed = data_gen_job is not None and data_gen_job.wait() != 0
+        for task in tasks:
+            task_log_dir = os.path.join(log_dir, task)
+            if data_gen_failed and task in missing_tasks:
+                print(f'Data generation for {task} ({seq_length_repr}) failed. Skipping...')
+                continue
 
             # Run response generation
             task_gen_cmd = (
@@ -163,11 +184,11 @@ def main(
                 f'--block_size {block_size} '
                 f'--anchor_block_size {anchor_block_size} '
                 f'--tokens_to_generate 128 '
-                f'--input_path {task_data_file} '
-                f'--output_path {os.path.join(results_dir, task)}.jsonl'
-                f'--stop_words {stop_words}'
+                f'--input_path {task_data_files[task]} '
+                f'--output_path {os.path.join(results_dir, task)}.jsonl '
+                f'--stop_words "{stop_words}"'
             )
-            submit_job(task_gen_cmd, task_log_dir, 'generate_predictions.sh')
+            submit_job(task_gen_cmd, task_log_dir, 'generate_predictions.sh').wait()
 
 
 if __name__ == '__main__':
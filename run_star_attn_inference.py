@@ -25,7 +25,7 @@ from tqdm import tqdm
 
 def read_jsonl(filename, num_lines=-1):
     lines = []
-    with open(filename) as f:
+    with open(filename, encoding='utf-8') as f:
         for i, line in enumerate(f):
             lines.append(json.loads(line))
             if i == num_lines: